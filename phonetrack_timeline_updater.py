@@ -16,13 +16,22 @@ Arguments:
 """
 
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from itertools import repeat
+from operator import attrgetter
 from pathlib import Path
+from typing import Iterable, Iterator
 import unicodedata
+import functools
 import argparse
+import json
+import mmap
 import logging
-import copy
-import glob
+import heapq
+import shutil
 import sys
 import re
 import os
@@ -42,6 +51,60 @@ logger = logging.getLogger(__name__)
 # GPX namespace
 GPX_NS = 'http://www.topografix.com/GPX/1/1'
 
+# datetime.fromisoformat() accepts a trailing 'Z' natively from Python 3.11
+ISOFORMAT_PARSES_Z = sys.version_info >= (3, 11)
+
+# Namespace-qualified tag names, as reported by ElementTree
+TRKSEG_TAG = f'{{{GPX_NS}}}trkseg'
+TRKPT_TAG = f'{{{GPX_NS}}}trkpt'
+EXTENSIONS_TAG = f'{{{GPX_NS}}}extensions'
+
+# trkpt children preserved in the timeline, keyed by qualified name
+POINT_CHILD_TAGS = {f'{{{GPX_NS}}}{tag}': tag for tag in ('time', 'ele', 'sat')}
+
+# PhoneTrack extension children preserved in the timeline, in output order
+EXTENSION_TAGS = ('speed', 'course', 'accuracy', 'batterylevel', 'useragent')
+EXTENSION_CHILD_TAGS = {f'{{{GPX_NS}}}{tag}': tag for tag in EXTENSION_TAGS}
+
+# Fixed parts of the timeline file
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+    'xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" '
+    'xmlns:wptx1="http://www.garmin.com/xmlschemas/WaypointExtension/v1" '
+    'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
+    'creator="PhoneTrack Timeline Updater" version="1.1" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">\n'
+)
+GPX_FOOTER = ' </trkseg>\n</trk>\n</gpx>\n'
+
+# Block size used when feeding GPX files to the XML parser
+PARSE_CHUNK_SIZE = 64 * 1024
+
+# Bytes read from each end of a timeline when checking whether new points can be appended
+TAIL_READ_SIZE = 64 * 1024
+
+# One trkpt exactly as write_gpx lays it out: time, optional ele/sat and
+# optional extensions with children in EXTENSION_TAGS order. Text excludes
+# '&' and '\r' so entities and newline normalisation go through the XML parser.
+# Groups: lat, lon, time, ele, sat, extensions, *EXTENSION_TAGS
+_WS = rb'[ \t\r\n]*'
+TRKPT_FAST_RE = re.compile(
+    _WS + rb'<trkpt lat="([^"<&\t\r\n]*)" lon="([^"<&\t\r\n]*)">' + _WS
+    + rb'<time>([^<&\r]*)</time>' + _WS
+    + rb'(?:<ele>([^<&\r]*)</ele>' + _WS + rb')?'
+    + rb'(?:<sat>([^<&\r]*)</sat>' + _WS + rb')?'
+    + rb'(?:(<extensions>)' + _WS
+    + b''.join(rb'(?:<%s>([^<&\r]*)</%s>' % (tag, tag) + _WS + rb')?'
+               for tag in (t.encode() for t in EXTENSION_TAGS))
+    + rb'</extensions>' + _WS + rb')?'
+    + rb'</trkpt>'
+)
+
+# Encoding named in a leading XML declaration, if any
+XML_ENCODING_RE = re.compile(rb'(?:\xef\xbb\xbf)?<\?xml\s[^>]*?\bencoding\s*=\s*["\']([^"\']*)["\']')
+
 # Regex for parsing PhoneTrack daily export filenames
 # Pattern: {SessionName}_daily_{YYYY-MM-DD}_{Username}.gpx
 DAILY_PATTERN = re.compile(r'^(.+)_daily_(\d{4}-\d{2}-\d{2})_(.+)\.gpx$')
@@ -49,14 +112,31 @@ DAILY_PATTERN = re.compile(r'^(.+)_daily_(\d{4}-\d{2}-\d{2})_(.+)\.gpx$')
 # Default paths for Nextcloud AIO
 DEFAULT_DATA_DIR = '/mnt/ncdata'
 TIMELINES_SUBDIR = 'TIMELINES'
+TIMELINE_SUFFIX = '_TIMELINE.gpx'
+STATE_SUBDIR = 'phonetrack_timelines'
+
+
+@dataclass(slots=True)
+class TrackPoint:
+    """A track point reduced to the values written back to the timeline."""
+    ts: datetime
+    lat: str
+    lon: str
+    position: int  # pack_position(lat, lon), used for deduplication
+    time: str
+    ele: str | None = None
+    sat: str | None = None
+    extensions: tuple[tuple[str, str], ...] | None = None
 
 
+@functools.lru_cache(maxsize=1024)
 def normalize_text(text: str) -> str:
     """Remove accents/diacritics from text."""
     normalized = unicodedata.normalize('NFD', text)
     return ''.join(c for c in normalized if unicodedata.category(c) != 'Mn')
 
 
+@functools.lru_cache(maxsize=1024)
 def parse_nextcloud_path(nc_path: str) -> tuple[str, str, str, str] | None:
     """
     Parse Nextcloud-relative path to extract user and filename info.
@@ -73,8 +153,10 @@ def parse_nextcloud_path(nc_path: str) -> tuple[str, str, str, str] | None:
     nc_user = parts[0]  # Nextcloud username (folder owner)
     filename = parts[-1]  # The GPX filename
     
-    # Parse the filename
-    match = DAILY_PATTERN.match(filename)
+    # Parse the filename (cheap suffix checks first; never re-merge a timeline)
+    match = None
+    if filename.endswith('.gpx') and not filename.endswith(TIMELINE_SUFFIX):
+        match = DAILY_PATTERN.match(filename)
     if not match:
         logger.warning(f"Filename doesn't match daily export pattern: {filename}")
         return None
@@ -86,114 +168,500 @@ def parse_nextcloud_path(nc_path: str) -> tuple[str, str, str, str] | None:
     return (nc_user, session_name, device_name, date_str)
 
 
+def pack_position(lat: str, lon: str) -> int:
+    """
+    Pack lat/lon into one int at 1e-7 degree resolution.
+
+    Equal coordinates written with different precision ("48.5" and
+    "48.50000") pack to the same value.
+    """
+    lat_e7 = round(float(lat) * 1e7)
+    lon_e7 = round(float(lon) * 1e7)
+    return (lat_e7 << 32) | (lon_e7 & 0xFFFFFFFF)
+
+
 def parse_timestamp(time_str: str) -> datetime:
     """Parse ISO format timestamp from GPX."""
-    if 'Z' in time_str:
-        return datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+    if ISOFORMAT_PARSES_Z:
+        return datetime.fromisoformat(time_str)
+    if time_str.endswith('Z'):
+        return datetime.fromisoformat(time_str[:-1] + '+00:00')
     return datetime.fromisoformat(time_str)
 
 
-def collect_track_points(file_path: Path) -> list[tuple[datetime, ET.Element]]:
-    """Collect all track points from a GPX file."""
+class _TrackPointTarget:
+    """
+    XMLParser target that reduces trkpt elements to TrackPoints.
+
+    Only the trkpt children written back by write_gpx are captured, with
+    the same first-match / leading-text semantics as Element.find().text,
+    and no element tree is ever built. Finished points accumulate in
+    self.points for the caller to drain between feed() calls.
+    """
+
+    def __init__(self):
+        self.points = []
+        self._depth = 0        # nesting level inside the current trkpt, 0 outside
+        self._in_ext = False   # inside the trkpt's first <extensions>
+        self._fields = {}
+        self._ext = None
+        self._capture = None   # (dict, key) receiving the current element's text
+        self._buf = []
+
+    def start(self, tag, attrib):
+        if not self._depth:
+            if tag == TRKPT_TAG:
+                self._depth = 1
+                self._fields = {'lat': attrib.get('lat'), 'lon': attrib.get('lon')}
+                self._ext = None
+            return
+
+        # Element text stops at the first child element
+        if self._capture is not None:
+            self._flush()
+        self._depth += 1
+
+        if self._depth == 2:
+            name = POINT_CHILD_TAGS.get(tag)
+            if name is not None:
+                if name not in self._fields:
+                    self._capture = (self._fields, name)
+            elif tag == EXTENSIONS_TAG and self._ext is None:
+                self._ext = {}
+                self._in_ext = True
+        elif self._depth == 3 and self._in_ext:
+            name = EXTENSION_CHILD_TAGS.get(tag)
+            if name is not None and name not in self._ext:
+                self._capture = (self._ext, name)
+
+    def data(self, text):
+        if self._capture is not None:
+            self._buf.append(text)
+
+    def end(self, tag):
+        if not self._depth:
+            return
+        if self._capture is not None:
+            self._flush()
+        if self._depth == 2:
+            self._in_ext = False
+        self._depth -= 1
+        if not self._depth:
+            self._finish_point()
+
+    def close(self):
+        return None
+
+    def _flush(self):
+        store, key = self._capture
+        store[key] = ''.join(self._buf)
+        self._buf.clear()
+        self._capture = None
+
+    def _finish_point(self):
+        fields = self._fields
+        extensions = None
+        if self._ext is not None:
+            ext = self._ext
+            extensions = tuple((tag, ext[tag]) for tag in EXTENSION_TAGS if ext.get(tag))
+
+        point = _make_track_point(fields['lat'], fields['lon'], fields.get('time'),
+                                  fields.get('ele'), fields.get('sat'), extensions)
+        if point is not None:
+            self.points.append(point)
+
+
+def _make_track_point(lat: str | None, lon: str | None, time_text: str | None,
+                      ele: str | None, sat: str | None,
+                      extensions: tuple[tuple[str, str], ...] | None) -> TrackPoint | None:
+    """Build a TrackPoint, or None if the point has no usable time or position."""
+    if not time_text or time_text.startswith('2000'):  # Skip year 2000 clock bug
+        return None
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        points = []
-        
-        for trkpt in root.findall('.//{%s}trkpt' % GPX_NS):
-            time_elem = trkpt.find('{%s}time' % GPX_NS)
-            if time_elem is not None and time_elem.text:
-                try:
-                    ts = parse_timestamp(time_elem.text)
-                    if ts.year == 2000:  # Skip year 2000 clock bug
-                        continue
-                    points.append((ts, copy.deepcopy(trkpt)))
-                except ValueError:
-                    pass
-        
-        return points
+        ts = parse_timestamp(time_text)
+    except ValueError:
+        return None
+    try:
+        position = pack_position(lat, lon)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return TrackPoint(ts, lat, lon, position, time_text, ele or None, sat or None, extensions)
+
+
+def _opens_gpx_trkseg(prefix: bytes) -> bool:
+    """Check that a trkpt placed right after prefix would be a GPX trkpt in a trkseg."""
+    probe = ET.XMLPullParser(events=('start', 'end'))
+    stack = []
+    try:
+        probe.feed(prefix)
+        probe.feed(b'<trkpt/>')
+        for event, elem in probe.read_events():
+            if event == 'end':
+                stack.pop()
+            elif elem.tag == TRKPT_TAG and stack[-1:] == [TRKSEG_TAG]:
+                return True
+            else:
+                stack.append(elem.tag)
+    except ET.ParseError:
+        pass
+    return False
+
+
+def _declares_utf8(prefix: bytes) -> bool:
+    """Check that a document starting with prefix is UTF-8, by its XML declaration or by default."""
+    m = XML_ENCODING_RE.match(prefix)
+    return m is None or m.group(1).lower() in (b'utf-8', b'utf8')
+
+
+def _remap_parse_error(error: ET.ParseError, data: mmap.mmap, first: int, resume: int) -> ET.ParseError:
+    """
+    Map a ParseError from a parser fed data[:first] + data[resume:] back to
+    its line and column in data.
+    """
+    line, column = error.position
+    join_line = data[:first].count(b'\n') + 1
+    if line == join_line:
+        column += ((resume - data.rfind(b'\n', 0, resume) - 1)
+                   - (first - data.rfind(b'\n', 0, first) - 1))
+    if line >= join_line:
+        line += sum(data[offset:min(offset + PARSE_CHUNK_SIZE, resume)].count(b'\n')
+                    for offset in range(first, resume, PARSE_CHUNK_SIZE))
+
+    message = str(error).rsplit(': line ', 1)[0]
+    remapped = ET.ParseError(f"{message}: line {line}, column {column}")
+    remapped.code = error.code
+    remapped.position = (line, column)
+    return remapped
+
+
+def _iter_fast_track_points(data: mmap.mmap, start: int) -> Iterator[tuple[int, TrackPoint | None]]:
+    """
+    Regex-match consecutive trkpts in write_gpx's layout from start.
+
+    Yields (end offset, point or None) per matched trkpt and stops at the
+    first thing that does not match.
+    """
+    match = TRKPT_FAST_RE.match
+    pos = start
+    while (m := match(data, pos)) is not None:
+        pos = m.end()
+        lat, lon, time_text, ele, sat, ext, *ext_values = m.groups()
+
+        extensions = None
+        if ext is not None:
+            extensions = tuple((tag, value.decode()) for tag, value
+                               in zip(EXTENSION_TAGS, ext_values) if value)
+
+        yield pos, _make_track_point(
+            lat.decode(), lon.decode(), time_text.decode(),
+            ele and ele.decode(), sat and sat.decode(), extensions,
+        )
+
+
+def iter_track_points(file_path: Path, strict: bool = False) -> Iterator[TrackPoint]:
+    """
+    Yield all track points from a GPX file, in file order.
+
+    A read or parse error is logged and ends the stream after the points
+    already yielded, unless strict is set, in which case it is raised.
+
+    The file is memory-mapped, since the regex needs the whole file as one
+    buffer and reading a timeline into bytes would undo the flat memory.
+    Runs of trkpts laid out exactly as write_gpx writes them (every
+    timeline, and any UTF-8 export in the same layout) are matched with a
+    single precompiled regex. Everything else is fed to the C XML parser
+    in fixed-size blocks: the document prefix plus whatever the fast path
+    did not consume, which is the original file minus points already
+    yielded. Memory stays flat either way.
+    """
+    target = _TrackPointTarget()
+    parser = ET.XMLParser(target=target)
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # Offset the XML parser resumes from after the fast path
+                    resume = 0
+                    first = data.find(b'<trkpt')
+                    if (first > 0 and _declares_utf8(data[:first])
+                            and _opens_gpx_trkseg(data[:first])):
+                        for resume, point in _iter_fast_track_points(data, first):
+                            if point is not None:
+                                yield point
+
+                    view = memoryview(data)
+                    try:
+                        if resume:
+                            parser.feed(view[:first])
+                        for offset in range(resume, len(view), PARSE_CHUNK_SIZE):
+                            parser.feed(view[offset:offset + PARSE_CHUNK_SIZE])
+                            yield from target.points
+                            target.points.clear()
+                        parser.close()
+                    except ET.ParseError as e:
+                        if not resume:
+                            raise
+                        raise _remap_parse_error(e, data, first, resume) from None
+                    finally:
+                        view.release()
+            else:
+                parser.close()
+        yield from target.points
     except Exception as e:
+        if strict:
+            raise
         logger.error(f"Failed to parse GPX file {file_path}: {e}")
-        return []
 
 
-def write_gpx(points: list[tuple[datetime, ET.Element]], 
+def merge_track_points(*sources: Iterable[TrackPoint]) -> Iterator[TrackPoint]:
+    """
+    Merge time-sorted point streams, dropping duplicates.
+
+    Points are duplicates when their timestamp and packed position match.
+    On ties the earlier source wins, so pass the existing timeline first.
+    """
+    current_ts = None
+    seen = set()
+    for pt in heapq.merge(*sources, key=attrgetter('ts')):
+        if pt.ts != current_ts:
+            current_ts = pt.ts
+            seen.clear()
+        if pt.position not in seen:
+            seen.add(pt.position)
+            yield pt
+
+
+def _write_track_points(write, points: Iterable[TrackPoint]) -> int:
+    """
+    Serialize points as trkpt elements through write.
+
+    Returns: number of points written
+    """
+    count = 0
+    n_extensions = len(EXTENSION_TAGS)
+
+    for pt in points:
+        count += 1
+        ext = pt.extensions
+
+        # Common case: ele, sat and every extension present, so the
+        # whole point is one precompiled f-string (EXTENSION_TAGS order).
+        # lat/lon and time already passed float() and fromisoformat(); any
+        # other text comes back entity-decoded from the parser, so escape it.
+        if pt.ele and pt.sat and ext is not None and len(ext) == n_extensions:
+            write(f'  <trkpt lat="{pt.lat}" lon="{pt.lon}">\n'
+                  f'   <time>{pt.time}</time>\n'
+                  f'   <ele>{escape(pt.ele)}</ele>\n'
+                  f'   <sat>{escape(pt.sat)}</sat>\n'
+                  f'   <extensions>\n'
+                  f'     <speed>{escape(ext[0][1])}</speed>\n'
+                  f'     <course>{escape(ext[1][1])}</course>\n'
+                  f'     <accuracy>{escape(ext[2][1])}</accuracy>\n'
+                  f'     <batterylevel>{escape(ext[3][1])}</batterylevel>\n'
+                  f'     <useragent>{escape(ext[4][1])}</useragent>\n'
+                  f'   </extensions>\n'
+                  f'  </trkpt>\n')
+            continue
+
+        write(f'  <trkpt lat="{pt.lat}" lon="{pt.lon}">\n'
+              f'   <time>{pt.time}</time>\n')
+
+        if pt.ele:
+            write(f'   <ele>{escape(pt.ele)}</ele>\n')
+
+        if pt.sat:
+            write(f'   <sat>{escape(pt.sat)}</sat>\n')
+
+        if ext is not None:
+            write('   <extensions>\n')
+            for tag, text in ext:
+                write(f'     <{tag}>{escape(text)}</{tag}>\n')
+            write('   </extensions>\n')
+
+        write('  </trkpt>\n')
+
+    return count
+
+
+def write_gpx(points: Iterable[TrackPoint],
               output_path: Path,
               session_name: str,
-              device_name: str) -> None:
-    """Write points to a GPX file with full PhoneTrack structure."""
+              device_name: str) -> int:
+    """
+    Write points to a GPX file with full PhoneTrack structure.
+
+    Returns: number of points written
+    """
     export_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
     
-    lines = [
-        '<?xml version="1.0" encoding="UTF-8" standalone="no" ?>',
-        '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
-        'xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" '
-        'xmlns:wptx1="http://www.garmin.com/xmlschemas/WaypointExtension/v1" '
-        'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" '
-        'creator="PhoneTrack Timeline Updater" version="1.1" '
-        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-        'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">',
-        '<metadata>',
-        f' <time>{export_time}</time>',
-        f' <name>{session_name}</name>',
-        '</metadata>',
-        '<trk>',
-        f' <name>{device_name}</name>',
-        ' <trkseg>',
-    ]
-
-    for ts, pt in points:
-        lat = pt.get('lat')
-        lon = pt.get('lon')
-        lines.append(f'  <trkpt lat="{lat}" lon="{lon}">')
-        
-        time_elem = pt.find('{%s}time' % GPX_NS)
-        if time_elem is not None:
-            lines.append(f'   <time>{time_elem.text}</time>')
-        
-        ele = pt.find('{%s}ele' % GPX_NS)
-        if ele is not None and ele.text:
-            lines.append(f'   <ele>{ele.text}</ele>')
-        
-        sat = pt.find('{%s}sat' % GPX_NS)
-        if sat is not None and sat.text:
-            lines.append(f'   <sat>{sat.text}</sat>')
-        
-        ext = pt.find('{%s}extensions' % GPX_NS)
-        if ext is not None:
-            lines.append('   <extensions>')
-            for tag in ['speed', 'course', 'accuracy', 'batterylevel', 'useragent']:
-                elem = ext.find('{%s}%s' % (GPX_NS, tag))
-                if elem is not None and elem.text:
-                    lines.append(f'     <{tag}>{elem.text}</{tag}>')
-            lines.append('   </extensions>')
-        
-        lines.append('  </trkpt>')
-
-    lines.extend([' </trkseg>', '</trk>', '</gpx>'])
+    header = (
+        '<metadata>\n'
+        f' <time>{export_time}</time>\n'
+        f' <name>{escape(session_name)}</name>\n'
+        '</metadata>\n'
+        '<trk>\n'
+        f' <name>{escape(device_name)}</name>\n'
+        ' <trkseg>\n'
+    )
 
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(lines))
+    # Points may be streamed from output_path itself, so write to a
+    # sibling .part file (ignored by Nextcloud) and swap it in at the end
+    tmp_path = output_path.with_name(output_path.name + '.part')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.write(GPX_HEADER)
+            f.write(header)
+            count = _write_track_points(f.write, points)
+            f.write(GPX_FOOTER)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
+    return count
 
-def update_timeline(new_file: Path, nc_path: str, data_dir: Path) -> bool:
+
+def find_timeline_tail(timeline_path: Path) -> tuple[int, datetime] | None:
+    """
+    Locate the last trkpt of a timeline written by write_gpx.
+
+    Returns: (offset just past the last </trkpt>, its timestamp), or None
+    if the file is not UTF-8 or does not start and end in write_gpx's layout
+    """
+    try:
+        with open(timeline_path, 'rb') as f:
+            head = f.read(TAIL_READ_SIZE)
+            size = f.seek(0, os.SEEK_END)
+            start = max(0, size - TAIL_READ_SIZE)
+            f.seek(start)
+            tail = f.read()
+    except OSError:
+        return None
+
+    # Appended points are UTF-8, so the timeline must be too
+    first = head.find(b'<trkpt')
+    if (first < 0 or not _declares_utf8(head[:first])
+            or not _opens_gpx_trkseg(head[:first])):
+        return None
+
+    # Nothing but the closing tags may follow the last trkpt
+    end = tail.rfind(b'</trkseg>')
+    if end < 0 or tail[end:].split() != GPX_FOOTER.encode().split():
+        return None
+    last = tail.rfind(b'<trkpt', 0, end)
+    m = TRKPT_FAST_RE.match(tail, last) if last >= 0 else None
+    if m is None or tail[m.end():end].strip():
+        return None
+
+    try:
+        ts = parse_timestamp(m.group(3).decode())
+    except ValueError:
+        return None
+    return start + m.end(), ts
+
+
+def append_gpx(points: Iterable[TrackPoint], timeline_path: Path, offset: int) -> int:
+    """
+    Append points to a timeline, after the trkpt ending at offset.
+
+    The timeline is copied as bytes (no parsing) to a sibling .part file,
+    the new points and closing tags replace its old closing tags, and the
+    copy is swapped in, so a failed append leaves the timeline untouched.
+
+    Returns: number of points written
+    """
+    chunks = ['\n']
+    count = _write_track_points(chunks.append, points)
+    chunks.append(GPX_FOOTER)
+
+    tmp_path = timeline_path.with_name(timeline_path.name + '.part')
+    try:
+        shutil.copyfile(timeline_path, tmp_path)
+        with open(tmp_path, 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            f.write(''.join(chunks).encode('utf-8'))
+        os.replace(tmp_path, timeline_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return count
+
+
+def find_daily_exports(export_dir: Path, date_str: str) -> list[Path]:
+    """
+    Find the daily export files for a date, sorted by name.
+
+    Uses a single os.scandir pass over the export directory (not its
+    TIMELINES subdirectory); names are filtered before any Path is built.
+    """
+    marker = f'_daily_{date_str}_'
+    try:
+        with os.scandir(export_dir) as entries:
+            names = [
+                entry.name for entry in entries
+                if marker in entry.name
+                and entry.name.endswith('.gpx')
+                and not entry.name.startswith('.')
+                and entry.is_file()
+            ]
+    except OSError as e:
+        logger.warning(f"Cannot list export directory {export_dir}: {e}")
+        return []
+
+    return [export_dir / name for name in sorted(names)]
+
+
+def load_merged_exports(state_path: Path) -> dict[str, list[int]]:
+    """
+    Load the record of daily exports already merged into a timeline.
+
+    Returns: {export filename: [size, mtime_ns]}, empty if missing or unreadable
+    """
+    try:
+        with open(state_path, encoding='utf-8') as f:
+            merged = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable merge state {state_path}: {e}")
+        return {}
+    return merged if isinstance(merged, dict) else {}
+
+
+def save_merged_exports(state_path: Path, merged: dict[str, list[int]]) -> None:
+    """Atomically write the record of daily exports merged into a timeline."""
+    try:
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = state_path.with_name(state_path.name + '.part')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(merged, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, state_path)
+    except OSError as e:
+        logger.warning(f"Failed to save merge state {state_path}: {e}")
+
+
+def update_timeline(new_file: Path, nc_path: str, data_dir: Path,
+                    force: bool = False) -> int | None:
     """
     Main function to update a timeline with new GPX data.
     
+    Exports already merged unchanged (same size and mtime) are skipped
+    unless force is set, so re-runs only cost the files that changed.
+    
     Args:
         new_file: Path to the new GPX file (temporary file from %f)
         nc_path: Nextcloud-relative path (%n)
         data_dir: Nextcloud data directory (/mnt/ncdata)
+        force: Merge even if this export was already merged unchanged
     
-    Returns: True if successful, False otherwise
+    Returns: number of points written (0 if skipped), or None on failure
     """
     # Parse the path
     parsed = parse_nextcloud_path(nc_path)
     if not parsed:
         logger.error(f"Could not parse Nextcloud path: {nc_path}")
-        return False
+        return None
     
     nc_user, session_name, device_name, date_str = parsed
     logger.info(f"Processing: User={nc_user}, Session={session_name}, Device={device_name}, Date={date_str}")
@@ -205,62 +673,157 @@ def update_timeline(new_file: Path, nc_path: str, data_dir: Path) -> bool:
     # Build timeline path
     # {data_dir}/{user}/files/PhoneTrack_export/TIMELINES/{Session}_{Device}_TIMELINE.gpx
     timeline_dir = data_dir / nc_user / 'files' / 'PhoneTrack_export' / TIMELINES_SUBDIR
-    timeline_filename = f"{clean_session}_{clean_device}_TIMELINE.gpx"
+    timeline_filename = f"{clean_session}_{clean_device}{TIMELINE_SUFFIX}"
     timeline_path = timeline_dir / timeline_filename
     
     logger.info(f"Timeline file: {timeline_path}")
     
-    # Collect points from new file
-    new_points = collect_track_points(new_file)
+    # Skip exports that were already merged and have not changed since
+    # {data_dir}/{user}/phonetrack_timelines/ is outside files/, so Nextcloud never indexes it
+    state_path = data_dir / nc_user / STATE_SUBDIR / f"{clean_session}_{clean_device}.json"
+    export_name = nc_path.replace('\\', '/').rsplit('/', 1)[-1]
+    try:
+        stat = new_file.stat()
+    except OSError as e:
+        logger.error(f"Cannot read new file {new_file}: {e}")
+        return None
+    signature = [stat.st_size, stat.st_mtime_ns]
+    merged = load_merged_exports(state_path) if timeline_path.exists() else {}
+    if not force and merged.get(export_name) == signature:
+        logger.info(f"Already merged and unchanged, skipping: {export_name} (use --force to re-merge)")
+        return 0
+    
+    # Collect points from new file (daily exports are small, sort in memory)
+    # All or nothing: a truncated export must not be merged, or recorded as merged, as a prefix
+    try:
+        new_points = list(iter_track_points(new_file, strict=True))
+    except Exception as e:
+        logger.error(f"Failed to parse GPX file {new_file}: {e}")
+        return None
     if not new_points:
         logger.warning(f"No valid track points in new file: {new_file}")
-        return False
+        return None
     
     logger.info(f"New file has {len(new_points)} track points")
-    
-    # Load existing timeline if exists
-    all_points = []
-    if timeline_path.exists():
-        existing_points = collect_track_points(timeline_path)
-        logger.info(f"Existing timeline has {len(existing_points)} points")
-        all_points.extend(existing_points)
+    new_points.sort(key=attrgetter('ts'))
+    
+    # Common case: every new point is later than the timeline's last one,
+    # so the new points can be appended without rereading the timeline
+    tail = find_timeline_tail(timeline_path) if timeline_path.exists() else None
+    if tail is not None and new_points[0].ts > tail[1]:
+        logger.info("New points follow the existing timeline, appending")
+        try:
+            count = append_gpx(merge_track_points(new_points), timeline_path, tail[0])
+        except Exception as e:
+            logger.error(f"Failed to append to {timeline_path}: {e}")
+            return None
+        logger.info(f"Timeline updated: {timeline_path} ({count} points appended)")
     else:
-        logger.info("No existing timeline, creating new one")
-    
-    # Add new points
-    all_points.extend(new_points)
-    
-    # Deduplicate
-    seen = set()
-    unique = []
-    for ts, pt in all_points:
-        key = (pt.get('lat'), pt.get('lon'), ts.isoformat())
-        if key not in seen:
-            seen.add(key)
-            unique.append((ts, pt))
-    
-    logger.info(f"After dedup: {len(unique)} unique points")
-    
-    # Sort by timestamp
-    unique.sort(key=lambda x: x[0])
-    
-    # Write timeline
-    write_gpx(unique, timeline_path, session_name, device_name)
-    logger.info(f"Timeline updated: {timeline_path}")
-    
-    # Trigger Nextcloud to rescan the file so it appears in the UI
+        # Stream the existing timeline (already time-sorted) if it exists
+        sources = []
+        if timeline_path.exists():
+            logger.info("Merging into existing timeline")
+            sources.append(iter_track_points(timeline_path, strict=True))
+        else:
+            logger.info("No existing timeline, creating new one")
+        sources.append(new_points)
+        
+        # Merge, deduplicate and write in a single streaming pass
+        # An unreadable timeline aborts the write, so it is never replaced by a truncated copy
+        try:
+            count = write_gpx(merge_track_points(*sources), timeline_path, session_name, device_name)
+        except Exception as e:
+            logger.error(f"Failed to merge into {timeline_path}, left unchanged: {e}")
+            return None
+        logger.info(f"Timeline updated: {timeline_path} ({count} points)")
+    
+    merged[export_name] = signature
+    save_merged_exports(state_path, merged)
+    
+    return count
+
+
+def scan_timelines(nc_user: str) -> None:
+    """
+    Trigger Nextcloud to rescan the user's timelines so changes appear in the UI.
+
+    Called once per run, after every timeline is written. The scan is
+    detached: nothing depends on its result, so don't wait for PHP to finish.
+    """
     try:
         timeline_nc_path = f"/{nc_user}/files/PhoneTrack_export/{TIMELINES_SUBDIR}"
         scan_cmd = ['php', '/var/www/html/occ', 'files:scan', nc_user, '--path', timeline_nc_path]
-        result = subprocess.run(scan_cmd, capture_output=True, text=True, timeout=60)
-        if result.returncode == 0:
-            logger.info(f"Nextcloud scan completed for {timeline_nc_path}")
-        else:
-            logger.warning(f"Nextcloud scan returned code {result.returncode}: {result.stderr}")
+        subprocess.Popen(scan_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+        logger.info(f"Nextcloud scan started for {timeline_nc_path}")
     except Exception as e:
         logger.warning(f"Failed to trigger Nextcloud scan: {e}")
-    
-    return True
+
+
+def group_exports_by_timeline(files: list[Path], nc_user: str) -> dict[str, list[Path]]:
+    """
+    Group daily export files by the timeline they update.
+
+    Files in one group share a timeline and must be merged one after the
+    other; separate groups can safely be processed in parallel.
+
+    Returns: {timeline name: files}, named like the timeline file without
+    its suffix (or the file name if it cannot be parsed)
+    """
+    groups = {}
+    for filepath in files:
+        parsed = parse_nextcloud_path(f"{nc_user}/files/PhoneTrack_export/{filepath.name}")
+        if parsed:
+            _, session_name, device_name, _ = parsed
+            key = f"{normalize_text(session_name)}_{normalize_text(device_name)}"
+        else:
+            key = filepath.name
+        groups.setdefault(key, []).append(filepath)
+    return groups
+
+
+class _LogPrefixFilter(logging.Filter):
+    """Prefix every log message, so parallel workers' lines can be told apart."""
+
+    def __init__(self, prefix: str):
+        super().__init__()
+        self.prefix = prefix
+
+    def filter(self, record):
+        record.msg = f"{self.prefix}{record.getMessage()}"
+        record.args = ()
+        return True
+
+
+def process_exports(files: list[Path], nc_user: str, data_dir: Path,
+                    force: bool = False, name: str | None = None) -> tuple[bool, bool]:
+    """
+    Merge daily export files into their timelines, in order.
+
+    If name is given, every message logged meanwhile is prefixed with it.
+
+    Returns: (True if every file was merged successfully,
+              True if any timeline was written)
+    """
+    log_filter = _LogPrefixFilter(f"[{name}] ") if name else None
+    if log_filter:
+        logger.addFilter(log_filter)
+    try:
+        all_ok = True
+        written = False
+        for filepath in files:
+            filename = filepath.name
+            nc_path = f"{nc_user}/files/PhoneTrack_export/{filename}"
+            logger.info(f"--- Processing: {filename} ---")
+            count = update_timeline(filepath, nc_path, data_dir, force)
+            if count is None:
+                all_ok = False
+            elif count:
+                written = True
+        return all_ok, written
+    finally:
+        if log_filter:
+            logger.removeFilter(log_filter)
 
 
 def main():
@@ -294,6 +857,17 @@ def main():
         default=Path(DEFAULT_DATA_DIR),
         help=f'Nextcloud data directory (default: {DEFAULT_DATA_DIR})'
     )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        help='Number of timelines to merge in parallel with --process-date '
+             '(default: CPU count)'
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Re-merge exports even if they were already merged unchanged'
+    )
     parser.add_argument(
         '--dry-run',
         action='store_true',
@@ -301,38 +875,50 @@ def main():
     )
     
     args = parser.parse_args()
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
     
     # Mode 1: Process all daily exports for a given date
     if args.process_date:
         if not args.user:
             parser.error('--user is required when using --process-date')
         export_dir = args.data_dir / args.user / 'files' / 'PhoneTrack_export'
-        pattern = str(export_dir / f'*_daily_{args.process_date}_*.gpx')
-        files = sorted(glob.glob(pattern))
+        files = find_daily_exports(export_dir, args.process_date)
         
         if not files:
             logger.info(f"No daily exports found for date {args.process_date}")
-            logger.info(f"Searched: {pattern}")
+            logger.info(f"Searched: {export_dir}")
             sys.exit(0)
         
         logger.info(f"=== Processing {len(files)} files for {args.process_date} ===")
-        all_ok = True
-        for filepath in files:
-            filepath = Path(filepath)
-            filename = filepath.name
-            nc_path = f"{args.user}/files/PhoneTrack_export/{filename}"
-            logger.info(f"--- Processing: {filename} ---")
-            if args.dry_run:
+        if args.dry_run:
+            for filepath in files:
+                filename = filepath.name
+                nc_path = f"{args.user}/files/PhoneTrack_export/{filename}"
+                logger.info(f"--- Processing: {filename} ---")
                 parsed = parse_nextcloud_path(nc_path)
                 if parsed:
                     _, session_name, device_name, date_str = parsed
                     logger.info(f"Would update timeline for: {session_name}_{device_name}")
-            else:
-                success = update_timeline(filepath, nc_path, args.data_dir)
-                if not success:
-                    all_ok = False
+            sys.exit(0)
+        
+        # Each timeline is independent, so merge them in parallel processes
+        groups = group_exports_by_timeline(files, args.user)
+        jobs = min(args.jobs or os.cpu_count() or 1, len(groups))
+        if jobs > 1:
+            logger.info(f"Merging {len(groups)} timelines with {jobs} workers")
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(
+                    process_exports, groups.values(),
+                    repeat(args.user), repeat(args.data_dir), repeat(args.force), groups
+                ))
+        else:
+            results = [process_exports(group, args.user, args.data_dir, args.force, name)
+                       for name, group in groups.items()]
         
-        sys.exit(0 if all_ok else 1)
+        if any(written for _, written in results):
+            scan_timelines(args.user)
+        sys.exit(0 if all(ok for ok, _ in results) else 1)
     
     # Mode 2: Process a single file (original mode)
     if not args.file or not args.path:
@@ -361,8 +947,10 @@ def main():
             logger.info(f"Would update timeline for: {session_name}_{device_name}")
         sys.exit(0)
     
-    success = update_timeline(args.file, args.path, args.data_dir)
-    sys.exit(0 if success else 1)
+    count = update_timeline(args.file, args.path, args.data_dir, args.force)
+    if count:
+        scan_timelines(parse_nextcloud_path(args.path)[0])
+    sys.exit(0 if count is not None else 1)
 
 
 if __name__ == '__main__':